@@ -1,23 +1,61 @@
 import os
 import io
+import asyncio
+import atexit
+import hashlib
 import logging
+import logging.handlers
+import queue
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+from cachetools import LRUCache, TTLCache
+from collections import defaultdict
 from datetime import datetime
 from PIL import Image
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from telegram.request import HTTPXRequest
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+
+# Настройка логирования: запись в stderr идет в отдельном потоке через очередь,
+# чтобы медленный вывод не блокировал цикл событий
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(queue.SimpleQueue(), _log_handler)
+# Форматирует только StreamHandler в потоке слушателя; QueueHandler передает
+# текст сообщения как есть, иначе префикс уровня и имени попадает в строку дважды
+_queue_handler = logging.handlers.QueueHandler(_log_listener.queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+
+# Опечатка в LOG_LEVEL не должна мешать запуску бота
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
 
-# Настройка логирования
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    handlers=[_queue_handler],
+    level=LOG_LEVEL if _log_level_valid else logging.WARNING
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+if not _log_level_valid:
+    logger.warning("Неизвестный LOG_LEVEL=%s, используется WARNING", LOG_LEVEL)
+
 # Конфигурация из переменных окружения
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# Публичный домен для webhook (на Render задается автоматически); без него - polling
+WEBHOOK_DOMAIN = os.getenv("WEBHOOK_DOMAIN") or os.getenv("RENDER_EXTERNAL_HOSTNAME")
+PORT = int(os.getenv("PORT", 8080))
+
+# Сколько обновлений Telegram обрабатывается одновременно
+MAX_CONCURRENT_UPDATES = 128
+
 # Проверка обязательных переменных
 if not TELEGRAM_TOKEN:
     logger.error("TELEGRAM_TOKEN не установлен!")
@@ -32,101 +70,329 @@ if not GEMINI_API_KEY:
 # Настройка Gemini
 genai.configure(api_key=GEMINI_API_KEY)
 
-# Хранилище данных пользователей
-user_data = {}
+MODEL_NAME = 'gemini-1.5-flash'
+MODEL = genai.GenerativeModel(MODEL_NAME)
+
+# Запасная модель на случай исчерпания квоты основной
+FALLBACK_MODEL_NAME = 'gemini-1.5-pro'
+FALLBACK_MODEL = genai.GenerativeModel(FALLBACK_MODEL_NAME)
+FALLBACK_DELAY = 1.0
+
+# Для распознавания еды Gemini достаточно ~768 px по длинной стороне
+IMAGE_MAX_SIDE = 768
+
+# Ограничения на входящие фото, чтобы один запрос не раздувал память
+MAX_PHOTO_BYTES = 4_000_000
+MAX_PHOTO_PIXELS = 20_000_000
+PHOTO_TOO_LARGE_TEXT = "❌ Фото слишком большое. Отправьте изображение поменьше."
+
+class PhotoTooLargeError(Exception):
+    """Фото превышает MAX_PHOTO_PIXELS и не декодируется"""
+
+PROMPT = """Ты - профессиональный диетолог. Проанализируй изображение еды и дай точную оценку калорийности.
+
+Верни ответ в формате:
+🍽 **Название блюда:** [название]
+
+📊 **ОБЩАЯ КАЛОРИЙНОСТЬ:** ~X ккал
+
+🍎 **ПИТАТЕЛЬНЫЙ СОСТАВ:**
+• Белки: X г
+• Жиры: X г  
+• Углеводы: X г
+
+📝 **СОСТАВ БЛЮДА:**
+- [ингредиент 1]
+- [ингредиент 2]
+
+💡 **РЕКОМЕНДАЦИИ:** [советы]"""
+
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest с разбором ответов Bot API через orjson"""
+    
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Некорректный UTF-8 и прочие ошибки - стандартная обработка PTB
+            return HTTPXRequest.parse_json_payload(payload)
+
+# Клавиатуры (статичные, создаются один раз)
+KB_MAIN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📸 Анализировать фото", callback_data="analyze")],
+    [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")]
+])
+
+KB_SUBSCRIBE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")],
+    [InlineKeyboardButton("📸 Анализировать фото", callback_data="analyze")]
+])
+
+KB_LIMIT_REACHED = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💎 Приобрести подписку", callback_data="subscribe")],
+    [InlineKeyboardButton("📊 Статистика", callback_data="stats")]
+])
+
+KB_STATS_FREE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💎 Приобрести подписку", callback_data="subscribe")],
+    [InlineKeyboardButton("📸 Анализировать фото", callback_data="analyze")]
+])
+
+KB_STATS_PREMIUM = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📸 Анализировать фото", callback_data="analyze")]
+])
+
+# Хранилище данных пользователей: SQLite на диске + горячий кэш в памяти
+DB_PATH = os.getenv("DB_PATH", "users.db")
+
+conn = sqlite3.connect(DB_PATH, isolation_level=None)
+conn.execute("PRAGMA journal_mode=WAL")
+conn.execute("PRAGMA synchronous=NORMAL")
+conn.execute(
+    "CREATE TABLE IF NOT EXISTS users("
+    "uid INTEGER PRIMARY KEY, requests_today INT, last_date INT, sub INT)"
+)
+conn.execute(
+    "CREATE TABLE IF NOT EXISTS analyses(hash BLOB PRIMARY KEY, result TEXT, created INT)"
+)
+if 'created' not in [col[1] for col in conn.execute("PRAGMA table_info(analyses)")]:
+    conn.execute("ALTER TABLE analyses ADD COLUMN created INT")
+
+# В памяти держим только активных пользователей, остальные подгружаются из SQLite
+user_data = TTLCache(maxsize=200_000, ttl=7 * 86400)
+
+# Неактивные бесплатные пользователи удаляются из базы через столько дней
+USER_RETENTION_DAYS = 30
 
 def get_user_data(user_id: int):
-    if user_id not in user_data:
-        user_data[user_id] = {
-            'requests_today': 0,
-            'last_request_date': None,
-            'subscription_active': False
-        }
+    if user_id in user_data:
+        return user_data[user_id]
+    
+    row = conn.execute(
+        "SELECT requests_today, last_date, sub FROM users WHERE uid=?", (user_id,)
+    ).fetchone()
+    if row is None:
+        # Строку в базе создаст первая запись счетчика (upsert в flush_pending_writes),
+        # чтобы /stats и кнопки не плодили пустые записи
+        row = (0, None, 0)
+    
+    requests_today, last_date, sub = row
+    user_data[user_id] = {
+        'requests_today': requests_today,
+        'last_request_date': int(last_date) if last_date is not None else None,
+        'subscription_active': bool(sub)
+    }
     return user_data[user_id]
 
+# Отложенная запись счетчиков: накапливаем в очереди и пишем пачкой раз в секунду
+_pending_writes = asyncio.Queue()
+FLUSH_INTERVAL = 1.0
+
+def save_user_data(user_id: int, user: dict):
+    """Ставит счетчик запросов пользователя в очередь на запись в SQLite"""
+    _pending_writes.put_nowait(
+        (user_id, user['requests_today'], user['last_request_date'], int(user['subscription_active']))
+    )
+
+def flush_pending_writes():
+    """Записывает накопленные счетчики одной транзакцией"""
+    batch = []
+    while not _pending_writes.empty():
+        batch.append(_pending_writes.get_nowait())
+    if not batch:
+        return
+    
+    # Строка могла быть удалена очисткой, пока пользователь был в кэше
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(
+            "INSERT INTO users(uid, requests_today, last_date, sub) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(uid) DO UPDATE SET requests_today=excluded.requests_today, last_date=excluded.last_date",
+            batch
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+async def flush_pending_writes_periodically():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            flush_pending_writes()
+        except Exception as e:
+            logger.error(f"Error in flush_pending_writes: {e}")
+
+def purge_inactive_users():
+    """Удаляет из базы бесплатных пользователей, неактивных дольше USER_RETENTION_DAYS"""
+    cutoff = datetime.now().toordinal() - USER_RETENTION_DAYS
+    # Строки с last_date IS NULL остались от старой версии, создававшей их при чтении;
+    # в них только значения по умолчанию, так что удалять их безопасно
+    deleted = conn.execute(
+        "DELETE FROM users WHERE sub=0 AND (last_date < ? OR last_date IS NULL)", (cutoff,)
+    ).rowcount
+    logger.info(f"Удалено неактивных пользователей: {deleted}")
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+async def cleanup_daily():
+    while True:
+        try:
+            purge_inactive_users()
+        except Exception as e:
+            logger.error(f"Error in purge_inactive_users: {e}")
+        try:
+            purge_old_analyses()
+        except Exception as e:
+            logger.error(f"Error in purge_old_analyses: {e}")
+        await asyncio.sleep(86400)
+
+# Блокировки на пользователя: проверка лимита и учет запроса не должны гоняться.
+# Блокировка живет, пока ее держат или ждут (счетчик ссылок), затем удаляется
+_user_locks = {}
+_user_lock_refs = defaultdict(int)
+
+# Текущий день (ординал), обновляется не чаще раза в минуту
+_today_ord = datetime.now().toordinal()
+_today_ts = time.monotonic()
+
+def get_today() -> int:
+    global _today_ord, _today_ts
+    now = time.monotonic()
+    if now - _today_ts > 60:
+        _today_ord = datetime.now().toordinal()
+        _today_ts = now
+    return _today_ord
+
 def can_make_request(user_id: int):
+    """Проверяет лимит; возвращает (можно ли, сообщение, данные пользователя)"""
     user = get_user_data(user_id)
-    today = datetime.now().date()
+    today = get_today()
     
     if user['last_request_date'] != today:
         user['requests_today'] = 0
         user['last_request_date'] = today
     
     if user['subscription_active']:
-        return True, ""
+        return True, "", user
     
     if user['requests_today'] < 3:
-        return True, ""
+        return True, "", user
     else:
         return False, """❌ Вы исчерпали лимит бесплатных запросов на сегодня (3/3)
 
-💎 Приобретите подписку для неограниченного анализа!"""
+💎 Приобретите подписку для неограниченного анализа!""", user
 
-async def analyze_with_gemini(image_data: bytes) -> str:
-    """Анализирует изображение через Google Gemini API"""
-    try:
-        # Подготовка изображения
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Пробуем разные модели
-        models_to_try = [
-            'gemini-1.0-pro-vision',
-            'gemini-pro-vision',
-            'gemini-1.5-flash',
-            'gemini-1.0-pro'
-        ]
-        
-        for model_name in models_to_try:
-            try:
-                model = genai.GenerativeModel(model_name)
-                
-                prompt = """Ты - профессиональный диетолог. Проанализируй изображение еды и дай точную оценку калорийности.
+# Кэш результатов анализа по хэшу содержимого фото (память -> SQLite)
+_analysis_cache = LRUCache(maxsize=2048)
 
-Верни ответ в формате:
-🍽 **Название блюда:** [название]
+# Результаты анализа хранятся в базе не дольше стольких дней
+ANALYSIS_RETENTION_DAYS = 30
 
-📊 **ОБЩАЯ КАЛОРИЙНОСТЬ:** ~X ккал
+def get_cached_analysis(image_hash: bytes):
+    if image_hash in _analysis_cache:
+        return _analysis_cache[image_hash]
+    
+    row = conn.execute("SELECT result FROM analyses WHERE hash=?", (image_hash,)).fetchone()
+    if row is None:
+        return None
+    
+    _analysis_cache[image_hash] = row[0]
+    return row[0]
+
+def save_analysis(image_hash: bytes, result: str):
+    _analysis_cache[image_hash] = result
+    conn.execute(
+        "INSERT OR REPLACE INTO analyses(hash, result, created) VALUES (?, ?, ?)",
+        (image_hash, result, get_today())
+    )
 
-🍎 **ПИТАТЕЛЬНЫЙ СОСТАВ:**
-• Белки: X г
-• Жиры: X г  
-• Углеводы: X г
+def purge_old_analyses():
+    """Удаляет из базы результаты анализа старше ANALYSIS_RETENTION_DAYS"""
+    cutoff = datetime.now().toordinal() - ANALYSIS_RETENTION_DAYS
+    # created IS NULL - записи, сохраненные до появления колонки
+    deleted = conn.execute(
+        "DELETE FROM analyses WHERE created < ? OR created IS NULL", (cutoff,)
+    ).rowcount
+    logger.info(f"Удалено старых результатов анализа: {deleted}")
 
-📝 **СОСТАВ БЛЮДА:**
-- [ингредиент 1]
-- [ингредиент 2]
+# file_unique_id Telegram -> хэш содержимого, чтобы не скачивать повторные фото
+_photo_hashes = LRUCache(maxsize=4096)
 
-💡 **РЕКОМЕНДАЦИИ:** [советы]"""
-                
-                logger.info(f"Пробуем модель: {model_name}")
-                response = model.generate_content([prompt, image])
-                
-                logger.info(f"Успешный ответ от модели {model_name}")
-                return response.text
-                
-            except Exception as e:
-                logger.warning(f"Модель {model_name} не сработала: {e}")
-                continue
+def decode_and_resize(image_data: bytes) -> Image.Image:
+    """Декодирует фото и уменьшает до IMAGE_MAX_SIDE по длинной стороне"""
+    try:
+        image = Image.open(io.BytesIO(image_data))
+    except Image.DecompressionBombError as e:
+        raise PhotoTooLargeError() from e
+    
+    # Image.open читает только заголовок, размер проверяем до декодирования
+    if image.width * image.height > MAX_PHOTO_PIXELS:
+        raise PhotoTooLargeError()
+    
+    image.draft('RGB', (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    return image.convert('RGB')
+
+async def analyze_with_gemini(image_data: bytes, image_hash: bytes) -> str:
+    """Анализирует изображение через Google Gemini API"""
+    cached = get_cached_analysis(image_hash)
+    if cached is not None:
+        return cached
+    
+    try:
+        # Декодирование в пуле потоков, чтобы не блокировать цикл событий
+        image = await asyncio.to_thread(decode_and_resize, image_data)
         
-        # Если ни одна модель не сработала
-        return "❌ Все модели Gemini API недоступны. Проверьте квоты и настройки billing."
+        try:
+            response = await MODEL.generate_content_async([PROMPT, image])
+            logger.debug("Успешный ответ от модели %s", MODEL_NAME)
+        except ResourceExhausted as e:
+            logger.warning("Квота %s исчерпана, повтор через %s: %s", MODEL_NAME, FALLBACK_MODEL_NAME, e)
+            await asyncio.sleep(FALLBACK_DELAY)
+            response = await FALLBACK_MODEL.generate_content_async([PROMPT, image])
+            logger.debug("Успешный ответ от модели %s", FALLBACK_MODEL_NAME)
+        save_analysis(image_hash, response.text)
+        return response.text
+    
+    except PhotoTooLargeError:
+        raise
             
     except Exception as e:
-        logger.error(f"Error in analyze_with_gemini: {e}")
+        logger.error("Error in analyze_with_gemini: %s", e)
         return f"❌ Ошибка Gemini API: {str(e)}"
 
 async def handle_photo(update: Update, context: CallbackContext) -> None:
+    # Фото одного пользователя обрабатываем по очереди, иначе параллельные
+    # запросы успевают пройти проверку лимита до увеличения счетчика
+    uid = update.effective_user.id
+    lock = _user_locks.get(uid)
+    if lock is None:
+        lock = _user_locks[uid] = asyncio.Lock()
+    _user_lock_refs[uid] += 1
+    try:
+        async with lock:
+            await process_photo(update, context)
+    finally:
+        _user_lock_refs[uid] -= 1
+        if not _user_lock_refs[uid]:
+            del _user_lock_refs[uid]
+            del _user_locks[uid]
+
+async def process_photo(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
+    photo = update.message.photo[-1]
+    
+    if photo.file_size and photo.file_size > MAX_PHOTO_BYTES:
+        await update.message.reply_text(PHOTO_TOO_LARGE_TEXT)
+        return
     
     # Проверяем лимит запросов
-    can_request, message = can_make_request(user.id)
+    can_request, message, user_data_obj = can_make_request(user.id)
     if not can_request:
-        keyboard = [
-            [InlineKeyboardButton("💎 Приобрести подписку", callback_data="subscribe")],
-            [InlineKeyboardButton("📊 Статистика", callback_data="stats")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(message, reply_markup=reply_markup)
+        await update.message.reply_text(message, reply_markup=KB_LIMIT_REACHED)
         return
     
     # Показываем что бот работает
@@ -137,16 +403,26 @@ async def handle_photo(update: Update, context: CallbackContext) -> None:
     )
     
     try:
-        # Получаем фото
-        photo_file = await update.message.photo[-1].get_file()
-        image_data = await photo_file.download_as_bytearray()
+        # Повторное фото: берем готовый результат без скачивания
+        image_hash = _photo_hashes.get(photo.file_unique_id)
+        analysis_result = get_cached_analysis(image_hash) if image_hash else None
         
-        # Анализируем изображение
-        analysis_result = await analyze_with_gemini(bytes(image_data))
+        if analysis_result is None:
+            # Получаем фото
+            photo_file = await photo.get_file()
+            buf = io.BytesIO()
+            await photo_file.download_to_memory(buf)
+            image_data = buf.getvalue()
+            image_hash = hashlib.blake2b(image_data, digest_size=16).digest()
+            _photo_hashes[photo.file_unique_id] = image_hash
+            
+            # Анализируем изображение
+            analysis_result = await analyze_with_gemini(image_data, image_hash)
         
-        # Обновляем счетчик запросов
-        user_data_obj = get_user_data(user.id)
+        # Обновляем счетчик запросов в том же объекте, что проверялся: за время
+        # анализа запись могла покинуть TTLCache, а в базе - данные без сброса дня
         user_data_obj['requests_today'] += 1
+        save_user_data(user.id, user_data_obj)
         
         # Добавляем информацию о использованных запросах
         requests_info = f"\n\n📊 Использовано запросов сегодня: {user_data_obj['requests_today']}/3"
@@ -155,30 +431,31 @@ async def handle_photo(update: Update, context: CallbackContext) -> None:
         
         full_response = analysis_result + requests_info
         
-        # Удаляем сообщение о обработке
-        await processing_msg.delete()
-        
-        # Отправляем результат
+        # Отправляем результат, заменяя сообщение о обработке
         if len(full_response) > 4000:
             full_response = full_response[:4000] + "\n\n... (сообщение обрезано)"
         
-        await update.message.reply_text(full_response)
+        await processing_msg.edit_text(full_response)
+    
+    except PhotoTooLargeError:
+        # Как и при превышении MAX_PHOTO_BYTES: отказ без списания запроса
+        await processing_msg.edit_text(PHOTO_TOO_LARGE_TEXT)
         
     except Exception as e:
-        logger.error(f"Error processing photo: {e}")
+        logger.error("Error processing photo: %s", e)
+        error_text = "❌ Произошла ошибка при обработке фото. Попробуйте еще раз."
+        # Показываем ошибку вместо сообщения о обработке; новое сообщение -
+        # только если сообщение о обработке отредактировать не удалось
         try:
-            await processing_msg.delete()
-        except:
-            pass
-        await update.message.reply_text("❌ Произошла ошибка при обработке фото. Попробуйте еще раз.")
+            await processing_msg.edit_text(error_text)
+        except Exception:
+            await update.message.reply_text(error_text)
 
-async def start(update: Update, context: CallbackContext) -> None:
-    user = update.effective_user
-    
-    welcome_text = f"""
+# Тексты сообщений: неизменная часть собирается один раз при импорте
+WELCOME_TMPL = """
 ✨ **Добро пожаловать в CalorieAI!** ✨
 
-Привет, {user.first_name}! 🎉
+Привет, {name}! 🎉
 
 Я - твой персональный диетолог с искусственным интеллектом! 📸🤖
 
@@ -193,36 +470,42 @@ async def start(update: Update, context: CallbackContext) -> None:
 • 💎 Премиум: неограниченно
 
 Просто отправь мне фото еды и я всё проанализирую! 📸
-    """
-    
-    keyboard = [
-        [InlineKeyboardButton("📸 Анализировать фото", callback_data="analyze")],
-        [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
+    """.format
 
-async def stats(update: Update, context: CallbackContext) -> None:
+async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
-    user_info = get_user_data(user.id)
+    welcome_text = WELCOME_TMPL(name=user.first_name)
     
-    stats_text = f"""
+    await update.message.reply_text(welcome_text, reply_markup=KB_MAIN, parse_mode='Markdown')
+
+STATS_TMPL_FREE = """
 📊 **Ваша статистика**
 
-👤 Пользователь: {user.first_name}
-📅 Запросов сегодня: {user_info['requests_today']}/3
-💎 Статус подписки: {'Активна ✅' if user_info['subscription_active'] else 'Неактивна ❌'}
+👤 Пользователь: {name}
+📅 Запросов сегодня: {requests}/3
+💎 Статус подписки: Неактивна ❌
 
-{'🎉 У вас неограниченный доступ!' if user_info['subscription_active'] else '💎 Приобретите подписку для неограниченного анализа!'}
-    """
+💎 Приобретите подписку для неограниченного анализа!
+    """.format
+
+STATS_TMPL_PREMIUM = """
+📊 **Ваша статистика**
+
+👤 Пользователь: {name}
+📅 Запросов сегодня: {requests}/3
+💎 Статус подписки: Активна ✅
+
+🎉 У вас неограниченный доступ!
+    """.format
+
+async def stats(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    user_info = get_user_data(user.id)
     
-    keyboard = []
-    if not user_info['subscription_active']:
-        keyboard.append([InlineKeyboardButton("💎 Приобрести подписку", callback_data="subscribe")])
-    keyboard.append([InlineKeyboardButton("📸 Анализировать фото", callback_data="analyze")])
+    stats_tmpl = STATS_TMPL_PREMIUM if user_info['subscription_active'] else STATS_TMPL_FREE
+    stats_text = stats_tmpl(name=user.first_name, requests=user_info['requests_today'])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = KB_STATS_PREMIUM if user_info['subscription_active'] else KB_STATS_FREE
     
     if update.callback_query:
         await update.callback_query.edit_message_text(stats_text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -233,18 +516,20 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
     
-    if query.data == "subscribe":
-        await subscribe_info(query)
-    elif query.data == "stats":
-        await stats(update, context)
-    elif query.data == "analyze":
-        await query.edit_message_text(
-            "📸 Отправьте фото еды для анализа калорий!\n\n"
-            "Совет: сделайте четкое фото при хорошем освещении для лучшего результата."
-        )
+    handler = CB_HANDLERS.get(query.data)
+    if handler:
+        await handler(update, context)
 
-async def subscribe_info(query):
-    subscribe_text = """
+async def cb_subscribe(update: Update, context: CallbackContext) -> None:
+    await subscribe_info(update.callback_query)
+
+async def cb_analyze(update: Update, context: CallbackContext) -> None:
+    await update.callback_query.edit_message_text(
+        "📸 Отправьте фото еды для анализа калорий!\n\n"
+        "Совет: сделайте четкое фото при хорошем освещении для лучшего результата."
+    )
+
+SUBSCRIBE_TEXT = """
 💎 **Премиум подписка**
 
 Получите неограниченный доступ к анализу калорий!
@@ -259,17 +544,18 @@ async def subscribe_info(query):
 
 ⚠️ *Оплата временно недоступна. Мы работаем над интеграцией платежной системы.*
     """
-    
-    keyboard = [
-        [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")],
-        [InlineKeyboardButton("📸 Анализировать фото", callback_data="analyze")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(subscribe_text, reply_markup=reply_markup, parse_mode='Markdown')
 
-async def help_command(update: Update, context: CallbackContext) -> None:
-    help_text = """
+async def subscribe_info(query):
+    await query.edit_message_text(SUBSCRIBE_TEXT, reply_markup=KB_SUBSCRIBE, parse_mode='Markdown')
+
+# Обработчики кнопок по callback_data
+CB_HANDLERS = {
+    "subscribe": cb_subscribe,
+    "stats": stats,
+    "analyze": cb_analyze,
+}
+
+HELP_TEXT = """
 🆘 **Помощь по боту**
 
 **📸 Как использовать:**
@@ -287,11 +573,52 @@ async def help_command(update: Update, context: CallbackContext) -> None:
 • Бесплатно: 3 анализа в сутки
 • С подпиской: неограниченно
     """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+async def help_command(update: Update, context: CallbackContext) -> None:
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
+
+async def post_init(application: Application) -> None:
+    """Фоновые задачи и прогрев соединения с Gemini до первого фото"""
+    # Пул потоков для asyncio.to_thread (декодирование фото)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=16))
+    _background_tasks.add(asyncio.create_task(flush_pending_writes_periodically()))
+    _background_tasks.add(asyncio.create_task(cleanup_daily()))
+    
+    # SDK держит один gRPC-канал (HTTP/2) на клиента и переиспользует его;
+    # асинхронный клиент создается лениво внутри цикла событий, поэтому
+    # открываем канал здесь, а не на первом запросе пользователя
+    try:
+        await MODEL.count_tokens_async(PROMPT)
+    except Exception as e:
+        logger.warning(f"Не удалось прогреть соединение с Gemini: {e}")
+
+async def post_shutdown(application: Application) -> None:
+    """Останавливаем фоновые задачи и дописываем счетчики, не попавшие в базу"""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    
+    flush_pending_writes()
 
 def main() -> None:
     """Запуск бота"""
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .rate_limiter(AIORateLimiter())
+        # По умолчанию PTB обрабатывает обновления строго по одному: долгий
+        # анализ фото задерживал бы /start, /stats и кнопки остальных пользователей
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .request(OrjsonRequest(connection_pool_size=256, pool_timeout=20))
+        # В режиме webhook getUpdates не используется
+        .get_updates_request(
+            OrjsonRequest(connection_pool_size=1 if WEBHOOK_DOMAIN else 16, pool_timeout=30)
+        )
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
@@ -308,11 +635,20 @@ def main() -> None:
     print("🧠 AI: Google Gemini")
     print("✅ Токен: Настроен")
     print("🔑 Gemini API: Настроен")
+    print(f"🌐 Режим: {'webhook' if WEBHOOK_DOMAIN else 'polling'}")
     print("📧 Команды: /start, /stats, /help")
     print("📸 Отправьте фото еды для анализа")
     print("=" * 50)
     
-    application.run_polling()
+    if WEBHOOK_DOMAIN:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"https://{WEBHOOK_DOMAIN}/{TELEGRAM_TOKEN}"
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()